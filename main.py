@@ -1,14 +1,24 @@
 # ==================== main.py ====================
 import os
 import re
+import string
 import time
+import asyncio
 import httpx
+import orjson
 import unicodedata
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from http.cookiejar import CookieJar, DefaultCookiePolicy
+from bisect import bisect_left
+from functools import lru_cache
 from urllib.parse import quote_plus
-from typing import List, Optional, Dict, Callable
+from typing import List, Optional, Dict, Callable, Awaitable, Union
 
+from cachetools import TTLCache
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel, Field
 
 # ---- Playwright opcional (último recurso) ----
@@ -16,14 +26,48 @@ PLAYWRIGHT_AVAILABLE = False
 USE_BROWSER_FALLBACK = os.getenv("USE_BROWSER_FALLBACK", "0") == "1"
 try:
     if USE_BROWSER_FALLBACK:
-        from playwright.sync_api import sync_playwright, TimeoutError as PWTimeoutError
+        from playwright.async_api import async_playwright, TimeoutError as PWTimeoutError
         PLAYWRIGHT_AVAILABLE = True
 except Exception:
     PLAYWRIGHT_AVAILABLE = False
     USE_BROWSER_FALLBACK = False
 
+# ---- Redis opcional (cache L2 compartido entre workers y reinicios) ----
+REDIS_URL = os.getenv("REDIS_URL", "")
+_REDIS = None
+try:
+    if REDIS_URL:
+        import redis.asyncio as aioredis
+        # Timeouts cortos: un Redis caído no puede frenar la búsqueda
+        _REDIS = aioredis.Redis.from_url(REDIS_URL, socket_timeout=0.5, socket_connect_timeout=0.5)
+except Exception:
+    _REDIS = None
+
 # ---------- FastAPI ----------
-app = FastAPI(title="Comparador UY (multi-competidor)", version="3.0.1")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # El esquema OpenAPI queda cacheado en app.openapi_schema: el primer
+    # /openapi.json (import de la Action) no lo arma en pleno arranque
+    app.openapi()
+    # DNS + TLS (+ SETTINGS h2) hechos antes del primer /compare
+    await _warm_http()
+    if USE_BROWSER_FALLBACK and PLAYWRIGHT_AVAILABLE:
+        # Chromium arranca con el proceso, no en la primera búsqueda que lo necesite
+        try: await _BROWSERS.get()
+        except Exception: pass
+    yield
+    # Cierre ordenado de recursos compartidos entre requests
+    await _BROWSERS.close_all()
+    await _HTTP.aclose()
+    if _REDIS is not None:
+        await _REDIS.aclose()
+
+app = FastAPI(
+    title="Comparador UY (multi-competidor)",
+    version="3.0.1",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan,
+)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -49,6 +93,15 @@ class ItemResult(BaseModel):
     url: Optional[str] = None
     notes: Optional[str] = None
 
+@dataclass(slots=True)
+class ScrapedProduct:
+    """Candidato leído de HTML (/busca o navegador), sin el envoltorio VTEX."""
+    name: str
+    slug: str
+    price: Optional[float]
+    list_price: Optional[float]
+    available: bool
+
 class CompareOut(BaseModel):
     competitor: str
     store: str
@@ -65,97 +118,274 @@ BASES = {
     "mily":     os.getenv("MILY_BASE",     "https://www.mily.com.uy"),
 }
 
-# Cache simple de 6hs
-_CACHE: Dict[str, dict] = {}
+# Cliente HTTP compartido (keep-alive entre búsquedas)
+_HEADERS = {"User-Agent": "Mozilla/5.0", "Accept-Language": "es-UY,es;q=0.9"}
+_HTTP = httpx.AsyncClient(
+    http2=True,
+    # Conexión con tope propio: un host caído no retiene la sonda 15s
+    timeout=httpx.Timeout(15, connect=5),
+    headers=_HEADERS,
+    follow_redirects=True,
+    limits=httpx.Limits(max_keepalive_connections=32, max_connections=64),
+    # Sin cookies: las búsquedas son anónimas y las de sesión VTEX sólo engordan cada request
+    cookies=CookieJar(policy=DefaultCookiePolicy(allowed_domains=[])),
+)
+
+async def _warm_http():
+    """HEAD a cada base para dejar la conexión abierta en el pool; los fallos no importan."""
+    await asyncio.gather(
+        *(_HTTP.head(b, timeout=5) for b in set(BASES.values())),
+        return_exceptions=True,
+    )
 
-BRANDS = {
+# Variantes de búsqueda por artículo (ver _build_tries)
+MAX_TRIES = 4
+
+# Ventana de resultados VTEX (OrderByScoreDESC): top 20, se amplía a 50 si nada puntúa
+VTEX_TO = 19
+VTEX_TO_WIDE = 49
+# Segundos de espera a la variante ft= antes de lanzar la de path como respaldo
+VTEX_HEDGE = float(os.getenv("VTEX_HEDGE", "1.5"))
+
+# Cola del buffer de PDP que se re-escanea con el chunk siguiente (match de precio incompleto)
+PDP_TAIL = 256
+
+# Contextos de navegador tibios (fallback Playwright)
+BROWSER_CONTEXTS = int(os.getenv("BROWSER_CONTEXTS", "3"))
+# Segundos sin fallback de navegador tras un fallo al lanzar Chromium
+BROWSER_COOLDOWN = 300
+
+# Búsquedas simultáneas por /compare
+MAX_CONCURRENCY = int(os.getenv("MAX_CONCURRENCY", "8"))
+# Sondas JSON/SSR en vuelo en todo el proceso (tries × artículos)
+MAX_PROBES = int(os.getenv("MAX_PROBES", "16"))
+_PROBES = asyncio.Semaphore(MAX_PROBES)
+
+# Cache LRU acotado con TTL de 6hs (el valor puede ser None: "sin coincidencias")
+CACHE_TTL = 6 * 3600
+_CACHE: TTLCache = TTLCache(maxsize=4096, ttl=CACHE_TTL)
+# Prefijo de claves en Redis: subir la versión al cambiar el scoring
+_REDIS_PREFIX = "cmp:v2:"
+_MISS = object()
+# Búsquedas en curso por clave de _CACHE: pedidos simultáneos comparten una sola
+_INFLIGHT: Dict[str, asyncio.Task] = {}
+# Búsquedas (competidor + try) que no devolvieron nada en ninguna capa; TTL corto
+NEG_TTL = 15 * 60
+_NEG_CACHE: TTLCache = TTLCache(maxsize=8192, ttl=NEG_TTL)
+# Ídem, pero VTEX confirmó el vacío (200 + []): se confía más tiempo
+_EMPTY_CACHE: TTLCache = TTLCache(maxsize=8192, ttl=3600)
+# Productos por (base + try): artículos distintos suelen compartir tries ("yerba canarias")
+_QUERY_CACHE: TTLCache = TTLCache(maxsize=2048, ttl=10 * 60)
+# Tries en curso por clave de _QUERY_CACHE: [task, cantidad de artículos esperándolo]
+_QUERY_INFLIGHT: Dict[str, list] = {}
+
+BRANDS = frozenset({
     "emigrante","shiva","maggi","knorr","costa","cololo","cocinero",
     "alco","himalaya","bella","union","bella union","arcor","nativa",
     "yerba","delicias","cimarron","marolio","adonis","san remo"
-}
-_STOP = {"de","la","el","los","las","un","una","con","en","a","y","x","sin","al","por","para","del"}
+})
+# Marcas de varias palabras: se buscan como frase, no por token
+_BRAND_PHRASES = tuple(b for b in BRANDS if " " in b)
+_BRAND_TOKENS = BRANDS.difference(_BRAND_PHRASES)
+_STOP = frozenset({"de","la","el","los","las","un","una","con","en","a","y","x","sin","al","por","para","del"})
+# Stopwords + envases/unidades sueltas: una sola búsqueda en _is_noise
+_NOISE_WORDS = frozenset(_STOP | {"pack","pct","bolsa","frasco","bot","pet","unidad","un"})
+
+# ---------- Regex precompiladas ----------
+_RE_NON_WORD = re.compile(r"[^\w\s]")
+# Masa y volumen en una sola pasada; la unidad decide a qué conjunto va
+_RE_SIZE = re.compile(r"(\d+)\s*(kg|gr|g|ml|l)")
+_UNIT_SCALE = {"kg": (1000, True), "gr": (1, True), "g": (1, True), "l": (1000, False), "ml": (1, False)}
+_RE_PRICE_STRIP = re.compile(r"[^0-9,\.]")
+_RE_TAGS = re.compile(r"<[^>]+>")
+_RE_PDP_HREF = re.compile(r'href="(/[^"]+/p)(?:\?[^"]*)?"', re.I)
+_RE_TITLE = re.compile(r"<title[^>]*>(.*?)</title>", re.I | re.S)
+_RE_HOST = re.compile(r"https?://[^/]+")
+
+# Precio en PDP: una sola pasada sobre el HTML con todas las variantes
+_RE_PDP_PRICE = re.compile(
+    r'itemprop="price"\s+content="(?P<itemprop>[0-9]+(?:[\.,][0-9]+)?)"'
+    r'|"price"\s*:\s*"(?P<ld>[0-9]+(?:[\.,][0-9]+)?)"'
+    r'|"Price"\s*:\s*(?P<vtex>[0-9]+(?:[\.,][0-9]+)?)'
+    r'|"ListPrice"\s*:\s*(?P<list>[0-9]+(?:[\.,][0-9]+)?)'
+    r'|\$ ?(?P<text>[\d\.\,]+)\s*</',
+    re.I,  # HTML de terceros: "PRICE"/"price" según el tema de la tienda
+)
+# Prioridad de cada variante (menor = mejor): un "$ 0,00" del minicart o el
+# ListPrice no le ganan al itemprop/Price aunque aparezcan antes en el HTML
+_PRICE_RANK = {"itemprop": 0, "ld": 1, "vtex": 2, "list": 3, "text": 4}
+_NO_PRICE = (len(_PRICE_RANK), None)
+
+# ---------- Tablas de normalización ----------
+# Acentos habituales en catálogos UY (ya en minúscula) → letra base
+_ACCENTS = str.maketrans({
+    "á": "a", "é": "e", "í": "i", "ó": "o", "ú": "u", "ü": "u", "ñ": "n",
+    "à": "a", "è": "e", "ì": "i", "ò": "o", "ù": "u",
+    "â": "a", "ê": "e", "î": "i", "ô": "o", "û": "u",
+    "ä": "a", "ë": "e", "ï": "i", "ö": "o", "ç": "c",
+    "ã": "a", "õ": "o", "ý": "y", "ÿ": "y",
+    "º": "o", "ª": "a", "\xa0": " ",  # ordinales y NBSP: frecuentes en nombres scrapeados
+})
+class _CombiningTable(dict):
+    """Tabla para str.translate que borra marcas combinantes; se llena a demanda."""
+    def __missing__(self, c: int):
+        v = self[c] = None if unicodedata.combining(chr(c)) else c
+        return v
+
+_DROP_COMBINING = _CombiningTable()
+# Equivalente ASCII de r"[^\w\s]" → " " ("_" es \w)
+_PUNCT_TO_SPACE = str.maketrans({c: " " for c in string.punctuation if c != "_"})
+
+# Borra todo lo Latin-1 que no sea dígito o separador (precios)
+_PRICE_DELETE = str.maketrans("", "", "".join(chr(i) for i in range(256) if chr(i) not in "0123456789,."))
 
 # ---------- Utils ----------
+@lru_cache(maxsize=16384)
 def _normalize(s: str) -> str:
-    s = (s or "").lower().strip()
-    s = unicodedata.normalize("NFKD", s)
-    s = "".join(ch for ch in s if not unicodedata.combining(ch))
-    s = re.sub(r"[^\w\s]", " ", s)
-    return re.sub(r"\s+", " ", s).strip()
-
+    s = (s or "").lower()
+    if not s.isascii():
+        s = s.translate(_ACCENTS)
+        if not s.isascii():
+            # Caracteres fuera de la tabla: camino lento NFKD
+            s = unicodedata.normalize("NFKD", s)
+            s = s.translate(_DROP_COMBINING)
+        s = _RE_NON_WORD.sub(" ", s)
+    else:
+        s = s.translate(_PUNCT_TO_SPACE)
+    return " ".join(s.split())
+
+@lru_cache(maxsize=16384)
 def _extract_sizes(text: str):
     t = _normalize(text)
     masses, vols = set(), set()
-    for m, unit in re.findall(r"(\d+)\s*(kg|g|gr)", t):
-        n = int(m); masses.add(n*1000 if unit == "kg" else n)
-    for m, unit in re.findall(r"(\d+)\s*(ml|l)", t):
-        n = int(m); vols.add(n*1000 if unit == "l" else n)
-    return masses, vols
+    for m, unit in _RE_SIZE.findall(t):
+        mult, is_mass = _UNIT_SCALE[unit]
+        (masses if is_mass else vols).add(int(m) * mult)
+    # frozenset: el resultado cacheado se comparte entre llamadas
+    return frozenset(masses), frozenset(vols)
 
 def _is_noise(t: str) -> bool:
-    if t in _STOP: return True
-    if re.fullmatch(r"\d+(kg|g|gr|ml|l)", t): return True
-    if re.fullmatch(r"\d+\s*(kg|g|gr|ml|l)", t): return True
-    if re.fullmatch(r"x\d+", t): return True
-    if t in {"pack","pct","bolsa","frasco","bot","pet","unidad","un"}: return True
-    return False
-
-def _build_tries(q: str) -> List[str]:
+    if t in _NOISE_WORDS: return True
+    # "xN" (pack) o número + unidad ("500g", "1kg"); los tokens no traen espacios
+    if t[:1] == "x":
+        return t[1:].isdecimal()
+    num = t.rstrip("kgmlr")
+    return num != t and num.isdecimal() and t[len(num):] in _UNIT_SCALE
+
+@lru_cache(maxsize=4096)
+def _build_tries(q: str) -> tuple:
     toks = _normalize(q).split()
     # "0000" sólo útil con HARINA
     if "0000" in toks and "harina" not in toks:
         toks = [t for t in toks if t != "0000"]
     toks_clean = [t for t in toks if not _is_noise(t)]
-    tries: List[str] = []
+    tries: Dict[str, None] = {}  # dict: orden de inserción + dedupe O(1)
     def add_try(tokens):
         s = " ".join(tokens).strip()
-        if s and s not in tries:
-            tries.append(s)
+        if s:
+            tries.setdefault(s, None)
+    add_try(toks_clean)        # limpio (mejor señal)
     add_try(toks)              # completo
-    add_try(toks_clean)        # limpio
+    marca = next((t for t in toks_clean if t in _BRAND_TOKENS), None)
+    if marca: add_try([marca])
     if len(toks_clean) >= 2:
         add_try(toks_clean[:2])
         add_try([toks_clean[1], toks_clean[0]])  # invertido
-    marcas = [t for t in toks_clean if t in BRANDS]
-    if marcas: add_try(marcas[:1])
     for t in toks_clean:
         if len(t) >= 4: add_try([t])             # token suelto (>=4)
-    return tries
+    # Cada try puede disparar la cascada completa (JSON → SSR → browser)
+    return tuple(tries)[:MAX_TRIES]
 
 def _parse_price(txt: str) -> Optional[float]:
     if not txt: return None
-    s = txt.replace("\xa0", " ").strip()
-    s = re.sub(r"[^0-9,\.]", "", s)
-    if "," in s and "." in s:
-        s = s.replace(".", "").replace(",", ".")
-    elif "," in s:
-        s = s.replace(",", ".")
+    s = txt.translate(_PRICE_DELETE)
+    if not s.isascii():
+        s = _RE_PRICE_STRIP.sub("", s)
+    # El separador más a la derecha es el decimal; el resto son miles
+    dec = max(s.rfind(","), s.rfind("."))
+    if dec >= 0:
+        s = s[:dec].replace(".", "").replace(",", "") + "." + s[dec + 1:]
     try: return float(s)
     except: return None
 
 def _strip_tags(s: str) -> str:
-    return re.sub(r"<[^>]+>", " ", s or "")
-
-def _score_product_from_query(p: dict, q_tokens: List[str], q_masses, q_vols, has_brand: bool) -> int:
-    name = _normalize(f"{p.get('productName','')} {p.get('linkText','')}")
-    s = 0
-    for tok in q_tokens:
-        if tok and tok in name: s += 1
-    if has_brand and any(b in name for b in BRANDS): s += 2
-    pm, pv = _extract_sizes(name)
+    # Títulos sin markup anidado (lo habitual): sin regex
+    if not s or "<" not in s: return s or ""
+    return _RE_TAGS.sub(" ", s)
+
+def _better_price(m, best: tuple) -> tuple:
+    """(rango, precio) entre best y el match m de _RE_PDP_PRICE."""
+    rank = _PRICE_RANK[m.lastgroup]
+    if rank < best[0]:
+        val = _parse_price(m.group(m.lastgroup))
+        if val is not None:
+            return rank, val
+    return best
+
+def _price_from_html(html: str) -> Optional[float]:
+    best = _NO_PRICE
+    for m in _RE_PDP_PRICE.finditer(html or ""):
+        best = _better_price(m, best)
+        if best[0] == 0:  # itemprop: no hay nada mejor
+            break
+    return best[1]
+
+def _name_slug(p) -> tuple:
+    """(nombre, slug) tanto de un producto VTEX (dict) como de un ScrapedProduct."""
+    if isinstance(p, ScrapedProduct):
+        return p.name, p.slug
+    return p.get("productName") or "", p.get("linkText") or ""
+
+def _product_features(p) -> tuple:
+    """Sólo lo que usa el scorer: (nombre normalizado, tokens, masas, volúmenes)."""
+    return _features_of(*_name_slug(p))
+
+# El mismo producto vuelve en varios tries y artículos: features por (nombre, slug)
+@lru_cache(maxsize=16384)
+def _features_of(name: str, slug: str) -> tuple:
+    norm = _normalize(f"{name} {slug}")
+    pm, pv = _extract_sizes(norm)
+    return norm, frozenset(norm.split()), pm, pv
+
+def _min_diff(q_sorted: tuple, values) -> int:
+    """Menor |q - v| con q_sorted ordenado: bisect por valor en vez de todos los pares."""
+    best = None
+    n = len(q_sorted)
+    for v in values:
+        i = bisect_left(q_sorted, v)
+        if i < n:
+            d = q_sorted[i] - v
+            if best is None or d < best: best = d
+        if i:
+            d = v - q_sorted[i - 1]
+            if best is None or d < best: best = d
+    return best
+
+def _has_brand(name: str, tokens: frozenset) -> bool:
+    """Marca por token ("maggi") o por frase sobre el nombre normalizado ("san remo")."""
+    return not tokens.isdisjoint(_BRAND_TOKENS) or any(b in name for b in _BRAND_PHRASES)
+
+def _score_product_from_query(feats: tuple, q_tokens: frozenset, q_masses, q_vols, has_brand: bool) -> int:
+    name, name_tokens, pm, pv = feats
+    s = len(q_tokens & name_tokens)
+    if has_brand and _has_brand(name, name_tokens): s += 2
     if q_masses and pm:
-        diff = min(abs(a-b) for a in q_masses for b in pm)
-        if min(q_masses) > 0:
-            pct = diff / float(min(q_masses))
+        diff = _min_diff(q_masses, pm)
+        if q_masses[0] > 0:  # ordenada: [0] es el mínimo
+            pct = diff / float(q_masses[0])
             s += 2 if pct <= 0.10 else (1 if pct <= 0.20 else 0)
     if q_vols and pv:
-        diff = min(abs(a-b) for a in q_vols for b in pv)
-        if min(q_vols) > 0:
-            pct = diff / float(min(q_vols))
+        diff = _min_diff(q_vols, pv)
+        if q_vols[0] > 0:  # ordenada: [0] es el mínimo
+            pct = diff / float(q_vols[0])
             s += 2 if pct <= 0.10 else (1 if pct <= 0.20 else 0)
     return s
 
-def _extract_prices(product: dict):
+def _extract_prices(product):
+    if isinstance(product, ScrapedProduct):
+        if product.price is None:
+            return None, None, False
+        return product.price, product.list_price or product.price, product.available
     try:
         for it in product.get("items", []) or []:
             for seller in it.get("sellers", []) or []:
@@ -169,60 +399,111 @@ def _extract_prices(product: dict):
         pass
     return None, None, False
 
-def _build_pdp_url(base: str, product: dict) -> Optional[str]:
-    slug = product.get("linkText")
+def _slim_product(p: dict) -> dict:
+    """
+    Producto VTEX reducido a lo que se usa (nombre, slug y la oferta que
+    elegiría _extract_prices). Lo que queda en las caches (y en Redis) pesa
+    una fracción del JSON original con imágenes, specs y sellers.
+    """
+    price, list_price, available = _extract_prices(p)
+    offer = [] if price is None else [{"sellers": [{"commertialOffer": {
+        "Price": price, "ListPrice": list_price, "IsAvailable": available}}]}]
+    return {"productName": p.get("productName"), "linkText": p.get("linkText"), "items": offer}
+
+def _build_pdp_url(base: str, product) -> Optional[str]:
+    slug = _name_slug(product)[1]
     if not slug: return None
     slug = slug.strip("/")
     base = base.rstrip("/")
     return f"{base}/{slug}/p"
 
 # ---------- Lectura de precio desde PDP (HTTPX) ----------
-def _price_from_pdp_httpx(full_url: str) -> Optional[float]:
-    headers = {"User-Agent": "Mozilla/5.0", "Accept-Language": "es-UY,es;q=0.9"}
+async def _price_from_pdp_httpx(full_url: str) -> Optional[float]:
+    """
+    Lee la PDP en streaming con la misma prioridad que _price_from_html. Sólo
+    itemprop corta la descarga; el resto de las variantes queda como respaldo
+    hasta el final del cuerpo. Del buffer sólo se conserva la cola sin
+    escanear: un match que llega al final, o al penúltimo carácter, puede
+    seguir en el próximo chunk ("Price": 12 → 1299, "Price": 129. → 129.9)
+    y se reescanea entero.
+    """
     try:
-        with httpx.Client(timeout=15, headers=headers, follow_redirects=True) as cli:
-            r = cli.get(full_url)
+        async with _HTTP.stream("GET", full_url) as r:
             if r.status_code != 200:
                 return None
-            html = r.text
-            for pat in [
-                r'itemprop="price"\s+content="([0-9]+(?:[\.,][0-9]+)?)"',
-                r'"price"\s*:\s*"([0-9]+(?:[\.,][0-9]+)?)"',
-                r'"Price"\s*:\s*([0-9]+(?:[\.,][0-9]+)?)',
-                r'"ListPrice"\s*:\s*([0-9]+(?:[\.,][0-9]+)?)',
-                r'\$ ?([\d\.\,]+)\s*</',
-            ]:
-                m = re.search(pat, html, re.I | re.S)
-                if m:
-                    val = _parse_price(m.group(1))
-                    if val is not None:
-                        return val
+            best, buf = _NO_PRICE, ""
+            async for chunk in r.aiter_text():
+                buf += chunk
+                cut = max(0, len(buf) - PDP_TAIL)
+                for m in _RE_PDP_PRICE.finditer(buf):
+                    # Hace falta ver el carácter siguiente al match para saber que terminó
+                    if m.end() >= len(buf) - 1:
+                        cut = m.start()
+                        break
+                    best = _better_price(m, best)
+                    if best[0] == 0:
+                        return best[1]
+                    cut = max(cut, m.end())
+                buf = buf[cut:]
+            # Fin del cuerpo: lo que quedó ya no puede crecer
+            for m in _RE_PDP_PRICE.finditer(buf):
+                best = _better_price(m, best)
+            return best[1]
     except Exception:
         pass
     return None
 
 # ---------- Estrategias de búsqueda ----------
-def _fetch_vtex_json(base: str, query: str):
+async def _fetch_vtex_json(base: str, query: str, to: int = VTEX_TO):
+    """
+    Devuelve (productos, estado). Estado "confident_empty": VTEX respondió 200
+    con lista vacía (el catálogo no conoce la búsqueda); "failed": timeout,
+    no-200 o JSON inválido en todas las variantes.
+    """
     base = base.rstrip("/")
     urls = [
-        f"{base}/api/catalog_system/pub/products/search?ft={quote_plus(query)}&_from=0&_to=99&O=OrderByScoreDESC&sc=1",
-        f"{base}/api/catalog_system/pub/products/search/{quote_plus(query)}?_from=0&_to=99&O=OrderByScoreDESC&sc=1",
+        f"{base}/api/catalog_system/pub/products/search?ft={quote_plus(query)}&_from=0&_to={to}&O=OrderByScoreDESC&sc=1",
+        f"{base}/api/catalog_system/pub/products/search/{quote_plus(query)}?_from=0&_to={to}&O=OrderByScoreDESC&sc=1",
     ]
-    headers = {"User-Agent": "Mozilla/5.0", "Accept-Language": "es-UY,es;q=0.9"}
-    with httpx.Client(timeout=15, headers=headers) as cli:
-        for url in urls:
-            try:
-                r = cli.get(url, follow_redirects=True)
-                if r.status_code != 200:
-                    continue
-                data = r.json()
-                if isinstance(data, list) and data:
-                    return data
-            except Exception:
-                continue
-    return []
 
-def _fetch_busca_html(base: str, query: str):
+    async def probe(url: str):
+        try:
+            r = await _HTTP.get(url)
+            if r.status_code != 200:
+                return None
+            data = orjson.loads(r.content)
+            if not isinstance(data, list):
+                return None
+            return [_slim_product(p) for p in data if isinstance(p, dict)]
+        except Exception:
+            return None
+
+    # ft= manda; la variante por path sólo cuenta si ft= no trae datos. Si
+    # ft= tarda más de VTEX_HEDGE, el path sale de respaldo para no sumar
+    # su latencia completa cuando ft= termina fallando
+    ft = asyncio.create_task(probe(urls[0]))
+    path = None
+    try:
+        done, _ = await asyncio.wait({ft}, timeout=VTEX_HEDGE)
+        if not done:
+            path = asyncio.create_task(probe(urls[1]))
+        data = await ft
+        if data:
+            return data, "ok"
+        answered = data is not None
+        if path is None:
+            path = asyncio.create_task(probe(urls[1]))
+        data = await path
+        if data:
+            return data, "ok"
+        answered = answered or data is not None
+    finally:
+        for task in (ft, path):
+            if task is not None:
+                task.cancel()
+    return [], ("confident_empty" if answered else "failed")
+
+async def _fetch_busca_html(base: str, query: str):
     """
     Fallback liviano: leer /busca SSR. Muchas VTEX no muestran precio SSR.
     Aquí tomamos links de PDP y vamos a la PDP a leer precio por HTTPX.
@@ -232,176 +513,386 @@ def _fetch_busca_html(base: str, query: str):
         f"{base}/busca?ft={quote_plus(query)}&O=OrderByScoreDESC&sc=1",
         f"{base}/busca?ft={quote_plus(query)}&sc=1",
     ]
-    headers = {"User-Agent": "Mozilla/5.0", "Accept-Language": "es-UY,es;q=0.9"}
-    found = []
-    seen = set()
-    with httpx.Client(timeout=15, headers=headers, follow_redirects=True) as cli:
-        for url in urls:
-            try:
-                r = cli.get(url)
-                if r.status_code != 200:
+    hrefs: List[str] = []
+    for url in urls:
+        try:
+            r = await _HTTP.get(url)
+            if r.status_code != 200:
+                continue
+            html = r.text
+            # Hasta 5 PDPs máximo para no castigar; finditer corta el escaneo
+            # apenas se juntan, sin materializar todos los links de la página
+            for m in _RE_PDP_HREF.finditer(html):
+                href = m.group(1)
+                if href in hrefs:
                     continue
-                html = r.text
-                # Hasta 5 PDPs máximo para no castigar
-                for href in re.findall(r'href="(/[^"]+/p)(?:\?[^"]*)?"', html, re.I):
-                    if href in seen:
-                        continue
-                    seen.add(href)
-                    slug = href.strip("/").split("/")[0]
-                    full = href if href.startswith("http") else (base + href)
-                    price = _price_from_pdp_httpx(full)
-                    found.append({
-                        "productName": _normalize(slug).replace("-", " "),
-                        "linkText": slug,
-                        "items": [{
-                            "sellers": [{
-                                "commertialOffer": {
-                                    "Price": price,
-                                    "ListPrice": price,
-                                    "IsAvailable": True if price is not None else False
-                                }
-                            }]
-                        }]
-                    })
-                    if len(found) >= 5:
-                        break
-                if found:
+                hrefs.append(href)
+                if len(hrefs) >= 5:
                     break
-            except Exception:
-                continue
+            if hrefs:
+                break
+        except Exception:
+            continue
+
+    fulls = [href if href.startswith("http") else (base + href) for href in hrefs]
+    prices = await asyncio.gather(*(_price_from_pdp_httpx(full) for full in fulls))
+    found = []
+    for href, price in zip(hrefs, prices):
+        slug = href.strip("/").split("/")[0]
+        found.append(ScrapedProduct(
+            name=_normalize(slug).replace("-", " "),
+            slug=slug,
+            price=price,
+            list_price=price,
+            available=price is not None,
+        ))
     return found
 
-def _search_with_browser(base: str, query: str, store_hint: str = ""):
-    """Fallback fuerte con navegador (opcional y desactivado por defecto)."""
-    if not (USE_BROWSER_FALLBACK and PLAYWRIGHT_AVAILABLE):
-        return []
-    results = []
-    base = base.rstrip("/")
-    search_url = f"{base}/busca?ft={quote_plus(query)}&O=OrderByScoreDESC&sc=1"
-    with sync_playwright() as p:
-        browser = p.chromium.launch(
-            headless=True,
-            args=["--no-sandbox","--disable-dev-shm-usage","--disable-gpu","--disable-setuid-sandbox"],
-        )
-        context = browser.new_context(
+class _BrowserPool:
+    """
+    Un Chromium persistente por proceso (todo corre en el event loop de uvicorn)
+    y hasta `size` BrowserContexts tibios que se reutilizan entre búsquedas;
+    por búsqueda sólo se abren/cierran páginas.
+    """
+    def __init__(self, size: int):
+        self._size = size
+        self._lock: Optional[asyncio.Lock] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._idle: List = []
+        self._pw = None
+        self._browser = None
+        self._down_until = 0.0
+
+    def available(self) -> bool:
+        """Circuit breaker: tras un fallo al lanzar Chromium se saltea el tier un rato."""
+        return time.monotonic() >= self._down_until
+
+    async def get(self):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        async with self._lock:
+            if self._browser is None or not self._browser.is_connected():
+                try:
+                    if self._pw is None:
+                        self._pw = await async_playwright().start()
+                    self._idle.clear()
+                    self._browser = await self._pw.chromium.launch(
+                        headless=True,
+                        args=["--no-sandbox","--disable-dev-shm-usage","--disable-gpu","--disable-setuid-sandbox"],
+                    )
+                except Exception:
+                    self._down_until = time.monotonic() + BROWSER_COOLDOWN
+                    raise
+            return self._browser
+
+    async def _new_context(self):
+        browser = await self.get()
+        context = await browser.new_context(
             locale="es-UY",
             user_agent=(
                 "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 "
                 "(KHTML, like Gecko) Chrome/123.0 Safari/537.36"
             ),
         )
-        page = context.new_page()
-        try:
-            page.goto(search_url, wait_until="domcontentloaded", timeout=45000)
-            page.wait_for_timeout(800)
-            anchors = page.locator('a[href$="/p"]').all()[:3]
-            for a in anchors:
-                try:
-                    href = a.get_attribute("href")
-                    if not href:
-                        continue
-                    full = href if href.startswith("http") else (base + href)
-                    page.goto(full, wait_until="domcontentloaded", timeout=45000)
-                    page.wait_for_timeout(600)
-                    html = page.content()
-
-                    # Nombre
-                    name = None
-                    try:
-                        name = page.locator("h1").first.text_content(timeout=2500)
-                        name = name.strip() if name else None
-                    except Exception:
-                        m = re.search(r"<title[^>]*>(.*?)</title>", html, re.I | re.S)
-                        name = _strip_tags(m.group(1)).strip() if m else None
-
-                    # Precio
-                    price = None
-                    for pat in [
-                        r'itemprop="price"\s+content="([0-9]+(?:[\.,][0-9]+)?)"',
-                        r'"Price"\s*:\s*([0-9]+(?:[\.,][0-9]+)?)',
-                        r'"ListPrice"\s*:\s*([0-9]+(?:[\.,][0-9]+)?)',
-                        r'\$ ?([\d\.\,]+)\s*</',
-                        r'"price"\s*:\s*"([0-9]+(?:[\.,][0-9]+)?)"',
-                    ]:
-                        m = re.search(pat, html, re.I | re.S)
-                        if m:
-                            price = _parse_price(m.group(1))
-                            if price is not None:
-                                break
-
-                    # Slug
-                    path = re.sub(r"https?://[^/]+", "", full)
-                    parts = [p for p in path.split("/") if p]
-                    slug = parts[-2] if parts and parts[-1] == "p" else (parts[-1] if parts else "")
-
-                    results.append({
-                        "productName": name or _normalize(slug).replace("-", " "),
-                        "linkText": slug,
-                        "items": [{
-                            "sellers": [{
-                                "commertialOffer": {
-                                    "Price": price,
-                                    "ListPrice": price,
-                                    "IsAvailable": True
-                                }
-                            }]
-                        }]
-                    })
-                except Exception:
-                    continue
-        except Exception:
-            pass
-        finally:
-            try: page.close()
-            except: pass
-            try: context.close()
+        await context.route("**/*", _block_heavy)
+        return context
+
+    def _alive(self, context) -> bool:
+        """El context es del Chromium actual y éste sigue conectado (no de uno caído)."""
+        return (self._browser is not None and context.browser is self._browser
+                and self._browser.is_connected())
+
+    async def _checkout(self):
+        # LIFO de tibios; los muertos se descartan en vez de envenenar el pool
+        while self._idle:
+            context = self._idle.pop()
+            if self._alive(context):
+                return context
+            try: await context.close()
+            except Exception: pass
+        return await self._new_context()
+
+    @asynccontextmanager
+    async def context(self):
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self._size)
+        async with self._slots:
+            context = await self._checkout()
+            try:
+                yield context
+            finally:
+                # Sólo vuelve al pool si sigue atado al navegador vivo actual
+                if self._alive(context):
+                    self._idle.append(context)
+                else:
+                    try: await context.close()
+                    except Exception: pass
+
+    async def close_all(self):
+        browser, pw = self._browser, self._pw
+        self._browser, self._pw = None, None
+        self._idle.clear()
+        if browser:
+            try: await browser.close()
             except: pass
-            try: browser.close()
+        if pw:
+            try: await pw.stop()
             except: pass
-    return results
-
-def _fetch_products_generic(base: str, query: str, store_hint: str = ""):
-    """Cascada: JSON → /busca SSR → Browser (opcional)."""
-    arr = _fetch_vtex_json(base, query)
-    if arr: return arr
-    arr = _fetch_busca_html(base, query)
-    if arr: return arr
-    arr = _search_with_browser(base, query, store_hint=store_hint)
+
+_BROWSERS = _BrowserPool(BROWSER_CONTEXTS)
+
+# Recursos que no aportan al HTML de precio/nombre
+_BLOCKED_RESOURCES = frozenset({"image", "font", "media", "stylesheet"})
+_BLOCKED_HOSTS = ("google-analytics.com", "googletagmanager.com", "facebook.net", "doubleclick.net", "hotjar.com")
+
+async def _block_heavy(route):
+    req = route.request
+    if req.resource_type in _BLOCKED_RESOURCES or any(h in req.url for h in _BLOCKED_HOSTS):
+        await route.abort()
+    else:
+        await route.continue_()
+
+async def _scrape_pdp_with_browser(context, full: str) -> Optional[ScrapedProduct]:
+    page = await context.new_page()
+    try:
+        await page.goto(full, wait_until="domcontentloaded", timeout=45000)
+        await page.wait_for_timeout(100)
+        html = await page.content()
+
+        # Nombre
+        name = None
+        try:
+            name = await page.locator("h1").first.text_content(timeout=2500)
+            name = name.strip() if name else None
+        except Exception:
+            m = _RE_TITLE.search(html)
+            name = _strip_tags(m.group(1)).strip() if m else None
+
+        # Precio
+        price = _price_from_html(html)
+
+        # Slug
+        path = _RE_HOST.sub("", full)
+        parts = [p for p in path.split("/") if p]
+        slug = parts[-2] if parts and parts[-1] == "p" else (parts[-1] if parts else "")
+
+        return ScrapedProduct(
+            name=name or _normalize(slug).replace("-", " "),
+            slug=slug,
+            price=price,
+            list_price=price,
+            available=True,
+        )
+    except Exception:
+        return None
+    finally:
+        try: await page.close()
+        except: pass
+
+async def _search_with_browser(base: str, query: str, store_hint: str = ""):
+    """Fallback fuerte con navegador (opcional y desactivado por defecto)."""
+    if not (USE_BROWSER_FALLBACK and PLAYWRIGHT_AVAILABLE and _BROWSERS.available()):
+        return []
+    base = base.rstrip("/")
+    search_url = f"{base}/busca?ft={quote_plus(query)}&O=OrderByScoreDESC&sc=1"
+    try:
+        async with _BROWSERS.context() as context:
+            page = await context.new_page()
+            try:
+                await page.goto(search_url, wait_until="domcontentloaded", timeout=45000)
+                await page.wait_for_timeout(800)
+                fulls = []
+                for a in (await page.locator('a[href$="/p"]').all())[:3]:
+                    href = await a.get_attribute("href")
+                    if href:
+                        fulls.append(href if href.startswith("http") else (base + href))
+            finally:
+                try: await page.close()
+                except: pass
+            # Las PDPs se abren en paralelo, una página por anchor
+            scraped = await asyncio.gather(*(_scrape_pdp_with_browser(context, full) for full in fulls))
+            return [r for r in scraped if r]
+    except Exception:
+        return []
+
+async def _race_json_ssr(base: str, query: str):
+    """
+    JSON y /busca SSR en paralelo: gana el primero que traiga productos y el
+    otro se cancela. Devuelve (productos, estado del JSON).
+    """
+    j = asyncio.create_task(_fetch_vtex_json(base, query))
+    h = asyncio.create_task(_fetch_busca_html(base, query))
+    pending = {j, h}
+    status = "failed"
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            # Si terminan juntos, el JSON tiene prioridad
+            for task in sorted(done, key=lambda t: t is not j):
+                if task is j:
+                    arr, status = task.result()
+                else:
+                    arr = task.result()
+                if arr:
+                    return arr, status
+        return [], status
+    finally:
+        for task in pending:
+            task.cancel()
+
+async def _fetch_products_generic(base: str, query: str, store_hint: str = ""):
+    """Cascada: (JSON ‖ /busca SSR) → Browser (opcional)."""
+    key = f"{base}:{query}"
+    if key in _NEG_CACHE or key in _EMPTY_CACHE:
+        return []
+    hit = _QUERY_CACHE.get(key)
+    if hit is not None:
+        return hit
+    # Mismo try ya en vuelo (otro artículo del batch u otro /compare): se espera ese
+    entry = _QUERY_INFLIGHT.get(key)
+    if entry is None:
+        task = asyncio.create_task(_fetch_products_cascade(base, query, key, store_hint))
+        entry = _QUERY_INFLIGHT[key] = [task, 0]
+        task.add_done_callback(lambda _: _QUERY_INFLIGHT.get(key) is entry and _QUERY_INFLIGHT.pop(key))
+    task = entry[0]
+    entry[1] += 1
+    try:
+        # shield: cancelar a un artículo no corta la descarga que espera otro
+        return await asyncio.shield(task)
+    except asyncio.CancelledError:
+        # Era el último interesado (corte temprano de _search_best): se cancela
+        # la cascada y se libera su lugar en _PROBES
+        if entry[1] == 1:
+            task.cancel()
+            if _QUERY_INFLIGHT.get(key) is entry:
+                del _QUERY_INFLIGHT[key]
+        raise
+    finally:
+        entry[1] -= 1
+
+async def _fetch_products_cascade(base: str, query: str, key: str, store_hint: str):
+    async with _PROBES:
+        arr, status = await _race_json_ssr(base, query)
+    if arr:
+        _QUERY_CACHE[key] = arr
+        return arr
+    if status == "confident_empty":
+        # El catálogo VTEX respondió y no conoce la búsqueda: no vale lanzar Chromium
+        _EMPTY_CACHE[key] = True
+        return []
+    arr = await _search_with_browser(base, query, store_hint=store_hint)
+    if arr:
+        _QUERY_CACHE[key] = arr
+    else:
+        _NEG_CACHE[key] = True
     return arr or []
 
 # ---------- BEST MATCH por competidor ----------
-def _best_generic(comp_key: str, q: str, store_hint: str) -> Optional[dict]:
+def _top_candidate(arr: List[dict], q_tokens: frozenset, q_masses, q_vols, has_brand: bool):
+    """
+    Puntúa en orden VTEX y conserva el primero ante empates. Si un producto
+    llega al máximo posible para la consulta (todos los tokens + marca +
+    masa + volumen), los siguientes no pueden superarlo y no se puntúan.
+    """
+    ceiling = len(q_tokens) + 2 * (has_brand + bool(q_masses) + bool(q_vols))
+    best_sc, best = -1, None
+    for p in arr:
+        sc = _score_product_from_query(_product_features(p), q_tokens, q_masses, q_vols, has_brand)
+        if sc > best_sc:
+            best_sc, best = sc, p
+            if sc >= ceiling:
+                break
+    return best_sc, best
+
+async def _best_generic(comp_key: str, q: str, store_hint: str) -> Optional[Union[dict, ScrapedProduct]]:
     base = BASES.get(comp_key)
     if not base:
         return None
     key = f"{comp_key}:{_normalize(q)}"
-    now = time.time()
-    hit = _CACHE.get(key)
-    if hit and now - hit["ts"] < 6 * 3600:
-        return hit["data"]
+    hit = _CACHE.get(key, _MISS)
+    if hit is not _MISS:
+        return hit
+
+    # Misma búsqueda ya en vuelo (otro artículo u otro /compare): se espera esa
+    task = _INFLIGHT.get(key)
+    if task is None:
+        task = asyncio.create_task(_search_shared(base, key, q, store_hint))
+        _INFLIGHT[key] = task
+        task.add_done_callback(lambda _: _INFLIGHT.pop(key, None))
+    # shield: si este request se cancela, la búsqueda compartida sigue (y
+    # llena _CACHE igual, desde el propio task)
+    return await asyncio.shield(task)
+
+def _l2_pack(best: Optional[Union[dict, ScrapedProduct]]) -> bytes:
+    # orjson serializa dataclasses; la marca permite reconstruir el ScrapedProduct
+    return orjson.dumps({"scraped": best} if isinstance(best, ScrapedProduct) else {"vtex": best})
+
+def _l2_unpack(raw: bytes) -> Optional[Union[dict, ScrapedProduct]]:
+    v = orjson.loads(raw)
+    return ScrapedProduct(**v["scraped"]) if "scraped" in v else v["vtex"]
+
+async def _search_shared(base: str, key: str, q: str, store_hint: str) -> Optional[Union[dict, ScrapedProduct]]:
+    """
+    Redis (si hay) y, si no está, la búsqueda real; una sola vez por clave en
+    vuelo. El resultado va a _CACHE acá y no en quien espera: si ese request
+    se cancela, la búsqueda terminada no se pierde.
+    """
+    if _REDIS is not None:
+        try:
+            raw = await _REDIS.get(_REDIS_PREFIX + key)
+            if raw is not None:
+                best = _CACHE[key] = _l2_unpack(raw)
+                return best
+        except Exception:
+            pass
+    best = _CACHE[key] = await _search_best(base, q, store_hint)
+    if _REDIS is not None:
+        # None también sale de una caída transitoria (timeouts, 5xx): TTL corto,
+        # como _NEG_CACHE, para no marcar el artículo como faltante 6hs en todos los workers
+        try: await _REDIS.set(_REDIS_PREFIX + key, _l2_pack(best), ex=CACHE_TTL if best is not None else NEG_TTL)
+        except Exception: pass
+    return best
 
-    tries = _build_tries(q)
+async def _search_best(base: str, q: str, store_hint: str) -> Optional[Union[dict, ScrapedProduct]]:
+    # Features de la consulta: se calculan una vez, fuera de cualquier scoring
+    q_norm = _normalize(q)
+    tries = _build_tries(q_norm)
     best, best_score = None, -1
-    q_tokens = _normalize(q).split()
-    q_masses, q_vols = _extract_sizes(q)
-    has_brand = any(t in BRANDS for t in q_tokens)
-
-    for t in tries:
-        arr = _fetch_products_generic(base, t, store_hint=store_hint)
-        if not arr: continue
-        arr.sort(key=lambda p: _score_product_from_query(p, q_tokens, q_masses, q_vols, has_brand), reverse=True)
-        cand = arr[0]
-        sc = _score_product_from_query(cand, q_tokens, q_masses, q_vols, has_brand)
-        if sc > best_score:
-            best, best_score = cand, sc
-        if best_score >= 3:
-            break
+    q_tokens = frozenset(q_norm.split())
+    q_masses, q_vols = (tuple(sorted(x)) for x in _extract_sizes(q_norm))
+    has_brand = _has_brand(q_norm, q_tokens)
+
+    # Todos los tries salen en paralelo; se consumen en orden de prioridad
+    # y al cortar se cancelan los que siguen en vuelo
+    tasks = [asyncio.create_task(_fetch_products_generic(base, t, store_hint=store_hint)) for t in tries]
+    try:
+        for task in tasks:
+            arr = await task
+            if not arr: continue
+            sc, cand = _top_candidate(arr, q_tokens, q_masses, q_vols, has_brand)
+            if sc > best_score:
+                best, best_score = cand, sc
+            if best_score >= 3:
+                break
+            # VTEX ya ordena por relevancia: con 5+ resultados no vale otra vuelta
+            if len(arr) >= 5:
+                break
+    finally:
+        for task in tasks:
+            task.cancel()
+
+    # Hubo resultados pero ninguno puntúa: una sola vuelta con ventana más ancha
+    if best is not None and best_score < 1 and tries:
+        arr, _ = await _fetch_vtex_json(base, tries[0], to=VTEX_TO_WIDE)
+        if arr:
+            sc, cand = _top_candidate(arr, q_tokens, q_masses, q_vols, has_brand)
+            if sc > best_score:
+                best, best_score = cand, sc
 
-    _CACHE[key] = {"ts": now, "data": best}
     return best
 
 # Mapeo de handlers por competidor
-HANDLERS: Dict[str, Callable[[str, str], Optional[dict]]] = {
+HANDLERS: Dict[str, Callable[[str, str], Awaitable[Optional[Union[dict, ScrapedProduct]]]]] = {
     "tata":     lambda q, store: _best_generic("tata", q, store),
     "eldorado": lambda q, store: _best_generic("eldorado", q, store),
     "elclon":   lambda q, store: _best_generic("elclon", q, store),
@@ -410,7 +901,7 @@ HANDLERS: Dict[str, Callable[[str, str], Optional[dict]]] = {
 
 # ---------- Endpoints ----------
 @app.get("/")
-def root():
+async def root():
     return {
         "status": "ok",
         "service": "comparador-uy-multi",
@@ -419,54 +910,76 @@ def root():
         "ts": int(time.time()),
     }
 
+def _item(q: str, status: str, name=None, price=None, listPrice=None, url=None, notes=None) -> dict:
+    """Fila de resultados con la forma de ItemResult, como dict plano."""
+    return {"input": q, "status": status, "name": name, "price": price,
+            "listPrice": listPrice, "url": url, "notes": notes}
+
+async def _process_item(handler, base: str, q: str, store: str, sem: asyncio.Semaphore) -> dict:
+    async with sem:
+        try:
+            prod = await handler(q, store)
+            if not prod:
+                return _item(q, "No disponible", notes="Sin coincidencias (JSON/HTML/PDP/Browser)")
+
+            price, list_price, available = _extract_prices(prod)
+            name, slug = _name_slug(prod)
+            name = (name or _normalize(slug).replace("-", " ")).strip()
+            url = _build_pdp_url(base, prod) if base else None
+
+            if price is None:
+                return _item(q, "No disponible", name=name, url=url, notes="Sin precio")
+
+            status = "OK" if available else "Sin stock"
+            return _item(q, status, name=name, price=price, listPrice=list_price, url=url)
+        except Exception as e:
+            return _item(q, "Error", notes=f"{type(e).__name__}: {e}")
+
+# Los resultados se arman en el servidor como dicts planos con la forma de
+# CompareOut/ItemResult: sin modelos por artículo ni model_dump, y el Response
+# directo saltea la serialización de response_model (que sigue documentando
+# el esquema en OpenAPI)
 @app.post("/compare", response_model=CompareOut)
-def compare(inb: CompareIn):
+async def compare(inb: CompareIn):
     comp = inb.competitor.lower().strip()
     handler = HANDLERS.get(comp)
     if not handler:
-        return CompareOut(
-            competitor=inb.competitor,
-            store=inb.store,
-            offset=inb.offset,
-            limit=inb.limit,
-            count=0,  # <— ESTA ERA LA LÍNEA CON ERROR
-            results=[ItemResult(input="", status="No implementado", notes=f"Competidor '{comp}' no configurado")]
-        )
+        return ORJSONResponse({
+            "competitor": inb.competitor,
+            "store": inb.store,
+            "offset": inb.offset,
+            "limit": inb.limit,
+            "count": 0,  # <— ESTA ERA LA LÍNEA CON ERROR
+            "results": [_item("", "No implementado", notes=f"Competidor '{comp}' no configurado")],
+        })
 
     items = inb.items or []
     start = max(inb.offset, 0)
     end = min(start + max(inb.limit, 1), len(items)) if items else start
     slice_items = items[start:end] if items else []
 
-    results: List[ItemResult] = []
     base = BASES.get(comp, "").rstrip("/")
-
+    sem = asyncio.Semaphore(MAX_CONCURRENCY)
+    # Artículos repetidos (misma búsqueda normalizada) se resuelven una sola
+    # vez y no ocupan lugares del semáforo esperando la misma búsqueda
+    uniq: Dict[str, str] = {}
     for q in slice_items:
-        try:
-            prod = handler(q, inb.store)
-            if not prod:
-                results.append(ItemResult(input=q, status="No disponible", notes="Sin coincidencias (JSON/HTML/PDP/Browser)"))
-                continue
-
-            price, list_price, available = _extract_prices(prod)
-            name = (prod.get("productName") or _normalize(prod.get("linkText","")).replace("-", " ")).strip()
-            url = _build_pdp_url(base, prod) if base else None
-
-            if price is None:
-                results.append(ItemResult(input=q, status="No disponible", name=name, url=url, notes="Sin precio"))
-                continue
-
-            status = "OK" if available else "Sin stock"
-            results.append(ItemResult(input=q, status=status, name=name, price=price, listPrice=list_price, url=url))
-        except Exception as e:
-            results.append(ItemResult(input=q, status="Error", notes=f"{type(e).__name__}: {e}"))
-
-    return CompareOut(
-        competitor=inb.competitor.upper(),
-        store=inb.store,
-        offset=inb.offset,
-        limit=inb.limit,
-        count=len(results),
-        results=results
+        uniq.setdefault(_normalize(q), q)
+    done = await asyncio.gather(
+        *(_process_item(handler, base, q, inb.store, sem) for q in uniq.values())
     )
+    by_key = dict(zip(uniq, done))
+    results: List[dict] = []
+    for q in slice_items:
+        r = by_key[_normalize(q)]
+        results.append(r if r["input"] == q else {**r, "input": q})
+
+    return ORJSONResponse({
+        "competitor": inb.competitor.upper(),
+        "store": inb.store,
+        "offset": inb.offset,
+        "limit": inb.limit,
+        "count": len(results),
+        "results": results,
+    })
 # ================== fin main.py ===================
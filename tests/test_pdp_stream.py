@@ -0,0 +1,42 @@
+import asyncio
+
+import httpx
+import pytest
+
+import main
+
+BODIES = [
+    '<script>{"Price": 129.9, "ListPrice": 150}</script>',
+    '<span class="minicart">$ 0,00</span><meta itemprop="price" content="189.00">',
+    '{"ListPrice": 250, "Price": 189}',
+    '<b>$ 1.234,50 </b> "price": "175.5"',
+    '"listprice": 300 "Price": 12,5 ',
+]
+
+
+class _Split(httpx.AsyncByteStream):
+    def __init__(self, data: bytes, at: int):
+        self.data, self.at = data, at
+
+    async def __aiter__(self):
+        yield self.data[:self.at]
+        yield self.data[self.at:]
+
+
+async def _streamed(body: bytes, at: int):
+    client = httpx.AsyncClient(transport=httpx.MockTransport(
+        lambda req: httpx.Response(200, stream=_Split(body, at))))
+    old, main._HTTP = main._HTTP, client
+    try:
+        return await main._price_from_pdp_httpx("https://tata.com.uy/x/p")
+    finally:
+        main._HTTP = old
+        await client.aclose()
+
+
+@pytest.mark.parametrize("html", BODIES)
+def test_stream_matches_full_body_at_every_split(html):
+    expected = main._price_from_html(html)
+    body = html.encode()
+    for at in range(len(body) + 1):
+        assert asyncio.run(_streamed(body, at)) == expected, at